@@ -9,8 +9,24 @@ import json
 import sys
 import argparse
 import os
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from datetime import timedelta
+from typing import Dict, Iterator, List, Optional
+
+from coder_api import parse_iso, format_iso, response_json
+
+try:
+    import ijson  # optional: lets large audit responses be stream-parsed
+except ImportError:
+    ijson = None
+
+
+# (resource_type, action) -> True if the event opens a session, False if it closes one
+_SESSION_EVENTS = {
+    ('workspace_build', 'start'): True,
+    ('workspace_build', 'stop'): False,
+    ('workspace_build', 'delete'): False,
+}
+
 
 class CoderLast:
     def __init__(self, coder_url: str, token: str):
@@ -22,7 +38,7 @@ class CoderLast:
             'Accept': 'application/json'
         })
     
-    def get_audit_logs(self, limit: int = 100, q: str = "") -> List[Dict]:
+    def get_audit_logs(self, limit: int = 100, q: str = "", offset: int = 0) -> List[Dict]:
         """Fetch audit logs from Coder API"""
         url = f"{self.coder_url}/api/v2/audit"
         params = {
@@ -30,22 +46,59 @@ class CoderLast:
         }
         if q:
             params['q'] = q
+        if offset:
+            params['offset'] = offset
             
         try:
             response = self.session.get(url, params=params)
             response.raise_for_status()
-            data = response.json()
+            data = response_json(response)
             return data.get('audit_logs', [])
-        except requests.RequestException as e:
+        except (requests.RequestException, ValueError) as e:
             print(f"Error fetching audit logs: {e}", file=sys.stderr)
             return []
     
+    def iter_audit_logs(self, limit: int = 100, q: str = "", offset: int = 0) -> Iterator[Dict]:
+        """Yield audit logs one at a time, stream-parsing the response when ijson is installed"""
+        if ijson is None:
+            yield from self.get_audit_logs(limit=limit, q=q, offset=offset)
+            return
+        
+        url = f"{self.coder_url}/api/v2/audit"
+        params = {
+            'limit': limit
+        }
+        if q:
+            params['q'] = q
+        if offset:
+            params['offset'] = offset
+            
+        try:
+            with self.session.get(url, params=params, stream=True) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                yield from ijson.items(response.raw, 'audit_logs.item')
+        except (requests.RequestException, ijson.JSONError) as e:
+            print(f"Error fetching audit logs: {e}", file=sys.stderr)
+    
+    def iter_audit_log_pages(self, page_size: int, q: str = "") -> Iterator[Dict]:
+        """Yield audit logs page by page (newest first, as the API returns them) until exhausted"""
+        offset = 0
+        while True:
+            count = 0
+            for log in self.iter_audit_logs(limit=page_size, q=q, offset=offset):
+                count += 1
+                yield log
+            if count < page_size:
+                return
+            offset += page_size
+    
     def format_duration(self, start_time: str, end_time: Optional[str] = None) -> str:
         """Format session duration like Unix last command"""
         try:
-            start = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+            start = parse_iso(start_time)
             if end_time:
-                end = datetime.fromisoformat(end_time.replace('Z', '+00:00'))
+                end = parse_iso(end_time)
                 duration = end - start
                 hours = int(duration.total_seconds() // 3600)
                 minutes = int((duration.total_seconds() % 3600) // 60)
@@ -65,73 +118,66 @@ class CoderLast:
         
         query = " ".join(query_parts)
         
-        logs = self.get_audit_logs(limit=limit * 2, q=query)
-        
-        # Process logs to extract session information
+        # The audit API returns logs newest first, so walk backwards in time:
+        # a stop/delete waits for the start that opened it, and we can stop
+        # paging as soon as enough sessions are found. Each session takes a
+        # start and a stop, so the first page usually holds all of them
         sessions = []
-        user_sessions = {}  # Track ongoing sessions per user
-        
-        # Sort logs chronologically (oldest first for processing)
-        sorted_logs = sorted(logs, key=lambda x: x.get('time', ''))
-        
-        for log in sorted_logs:
-            user = log.get('user', {}).get('username', 'unknown')
-            action = log.get('action', '')
-            time_str = log.get('time', '')
-            resource_type = log.get('resource_type', '')
-            ip = log.get('ip', '')
-            resource_target = log.get('resource_target', '')
-            additional_fields = log.get('additional_fields', {})
+        pending_stops = {}  # (user, workspace) -> newer stop/delete awaiting its start
+        started = set()     # (user, workspace) whose most recent start was already seen
+        for log in self.iter_audit_log_pages(page_size=max(limit * 2, 100), q=query):
+            g = log.get
+            opens = _SESSION_EVENTS.get((g('resource_type'), g('action')))
+            if opens is None:
+                continue
+            try:
+                user = log['user']['username']
+            except (KeyError, TypeError):
+                user = 'unknown'
+            try:
+                workspace_name = log['additional_fields']['workspace_name']
+            except (KeyError, TypeError):
+                workspace_name = g('resource_target') or 'workspace'
+            time_str = g('time', '')
+            key = (user, workspace_name)
             
-            # Parse workspace build events
-            if resource_type == 'workspace_build':
-                workspace_name = additional_fields.get('workspace_name', resource_target or 'workspace')
-                
-                if action == 'start':
-                    # Workspace start indicates user session start
-                    session_key = f"{user}:{workspace_name}"
-                    user_sessions[session_key] = {
-                        'start_time': time_str,
-                        'ip': ip,
-                        'workspace': workspace_name,
-                        'user': user
-                    }
-                elif action in ['stop', 'delete']:
-                    # Workspace stop indicates end of session
-                    session_key = f"{user}:{workspace_name}"
-                    if session_key in user_sessions:
-                        session = user_sessions[session_key]
-                        sessions.append({
-                            'username': user,
-                            'terminal': workspace_name[:24],
-                            'ip': session.get('ip', ''),
-                            'start_time': session['start_time'],
-                            'end_time': time_str,
-                            'duration': self.format_duration(session['start_time'], time_str)
-                        })
-                        del user_sessions[session_key]
-        
-        # Add ongoing sessions
-        for session in user_sessions.values():
-            sessions.append({
-                'username': session['user'],
-                'terminal': session['workspace'][:24],
-                'ip': session.get('ip', ''),
-                'start_time': session['start_time'],
-                'end_time': None,
-                'duration': 'still logged in'
-            })
-        
-        # Sort by start time (most recent first)
-        sessions.sort(key=lambda x: x['start_time'], reverse=True)
+            if not opens:
+                # An older stop supersedes a newer one that had no start in between
+                pending_stops[key] = time_str
+                continue
+            
+            end_time = pending_stops.pop(key, None)
+            if end_time is not None:
+                sessions.append({
+                    'username': user,
+                    'terminal': workspace_name[:24],
+                    'ip': g('ip', ''),
+                    'start_display': self.format_time(time_str),
+                    'end_display': self.format_time(end_time),
+                    'duration': self.format_duration(time_str, end_time)
+                })
+            elif key not in started:
+                # The most recent start without a later stop is still ongoing
+                sessions.append({
+                    'username': user,
+                    'terminal': workspace_name[:24],
+                    'ip': g('ip', ''),
+                    'start_display': self.format_time(time_str),
+                    'end_display': None,
+                    'duration': 'still logged in'
+                })
+            # Otherwise a newer start replaced this one before any stop
+            started.add(key)
+            
+            if len(sessions) >= limit:
+                break
         
         return sessions[:limit]
     
     def format_time(self, time_str: str) -> str:
         """Format time like Unix last command"""
         try:
-            dt = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
-            return dt.strftime('%a %b %d %H:%M')
+            return format_iso(time_str, '%a %b %d %H:%M')
         except:
             return time_str
     
@@ -142,22 +188,14 @@ class CoderLast:
             return
         
         for session in sessions:
-            username = session['username'][:8].ljust(8)  # Truncate/pad username
-            terminal = session['terminal'][:24].ljust(24)  # Terminal/workspace name
-            
-            if show_hostnames and session['ip']:
-                hostname = session['ip'][:16].ljust(16)
-            else:
-                hostname = " " * 16
-            
-            start_time = self.format_time(session['start_time'])
+            # Field specs truncate and pad in one step: user 8, workspace 24, host 16
+            hostname = session['ip'] if show_hostnames and session['ip'] else ''
             
-            if session['end_time']:
-                end_time = self.format_time(session['end_time'])
-                duration = session['duration']
-                print(f"{username} {terminal} {hostname} {start_time} - {end_time} {duration}")
+            if session['end_display']:
+                tail = f"- {session['end_display']} {session['duration']}"
             else:
-                print(f"{username} {terminal} {hostname} {start_time} {session['duration']}")
+                tail = session['duration']
+            print(f"{session['username']:<8.8} {session['terminal']:<24.24} {hostname:<16.16} {session['start_display']} {tail}")
     
     def show_system_events(self, limit: int = 20):
         """Show system reboot/shutdown equivalent events"""
@@ -225,10 +263,8 @@ Examples:
         coder_last.print_sessions(sessions, not args.no_hostname)
         
         if sessions:
-            # Show log file info like Unix last
-            earliest_time = min(s['start_time'] for s in sessions if s['start_time'])
-            earliest_formatted = coder_last.format_time(earliest_time)
-            print(f"\naudit logs begin {earliest_formatted}")
+            # Show log file info like Unix last; sessions are newest first
+            print(f"\naudit logs begin {sessions[-1]['start_display']}")
 
 
 if __name__ == '__main__':
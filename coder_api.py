@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Coder API helpers
+
+Session setup, timestamp parsing and JSON decoding shared by the scripts, so each fix lands in one place.
+"""
+
+import datetime
+import functools
+import sys
+from datetime import timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional: faster decoding of large API responses
+except ImportError:
+    orjson = None
+
+UTC = timezone.utc
+
+# Python 3.11+ parses the trailing 'Z' natively; older versions need it rewritten
+if sys.version_info >= (3, 11):
+    fromisoformat = datetime.datetime.fromisoformat
+else:
+    def fromisoformat(date_str):
+        return datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+
+
+def fast_parse_z(s):
+    """Parse Coder's fixed-width UTC timestamps by slicing, falling back to fromisoformat"""
+    n = len(s)
+    if s[-1:] != 'Z' or not (n == 20 or (n == 27 and s[19] == '.')):
+        return datetime.datetime.fromisoformat(s[:-1] + '+00:00' if s.endswith('Z') else s)
+    return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                             int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                             int(s[20:26]) if n == 27 else 0, tzinfo=UTC)
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_iso(ts):
+    """Parse an ISO-8601 timestamp from the API (memoized, timestamps repeat a lot)"""
+    return fast_parse_z(ts)
+
+
+@functools.lru_cache(maxsize=8192)
+def format_iso(ts, fmt):
+    """Format an ISO-8601 timestamp, so strftime runs once per unique timestamp"""
+    return parse_iso(ts).strftime(fmt)
+
+
+def response_json(response):
+    """Decode a JSON response body, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def build_session(token=None):
+    """Build an API session: pooled connections and retries on transient errors"""
+    session = requests.Session()
+    session.headers['Accept'] = 'application/json'
+    if token:
+        session.headers['Coder-Session-Token'] = token
+    session.mount("https://", HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+    ))
+    return session
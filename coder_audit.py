@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
-import requests
 import json
 import datetime
+import functools
+import bisect
 from datetime import timezone, timedelta
 import os
 from tabulate import tabulate
 
+from coder_api import parse_iso, format_iso, response_json, build_session
+
 # Get the API token from file or environment variable
+@functools.lru_cache(maxsize=1)
 def get_token():
     if os.path.exists("audit-token.txt"):
         with open("audit-token.txt", "r") as f:
@@ -25,29 +29,18 @@ FQDN = get_fqdn()
 # FQDN="My URL"
 # Add your token to audit-token.txt or update here
 CODER_URL = f"{FQDN}"
-TOKEN = get_token()
-
-headers = {
-    'Accept': 'application/json',
-    'Coder-Session-Token': TOKEN
-}
 
-def get_audit_logs():
-    """Fetch audit logs from Coder API"""
-    url = f"{CODER_URL}/api/v2/audit?limit=0"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()["audit_logs"]
-    else:
-        print(f"Error fetching audit logs: {response.status_code}")
-        return []
+@functools.lru_cache(maxsize=1)
+def _session():
+    """Build the shared API session on first use so every call reuses its pooled connection"""
+    return build_session(get_token())
 
 def get_workspaces():
     """Fetch workspaces from Coder API"""
     url = f"{CODER_URL}/api/v2/workspaces"
-    response = requests.get(url, headers=headers)
+    response = _session().get(url)
     if response.status_code == 200:
-        return response.json()["workspaces"]
+        return response_json(response)["workspaces"]
     else:
         print(f"Error fetching workspaces: {response.status_code}")
         return []
@@ -55,53 +48,47 @@ def get_workspaces():
 def get_templates():
     """Fetch templates from Coder API"""
     url = f"{CODER_URL}/api/v2/templates"
-    response = requests.get(url, headers=headers)
+    response = _session().get(url)
     if response.status_code == 200:
         # API returns a list directly, not an object with "templates" key
-        return response.json()
+        return response_json(response)
     else:
         print(f"Error fetching templates: {response.status_code}")
         return []
 
+
 def format_date(date_str):
     """Format date string to a more readable format"""
     if not date_str or date_str == "0001-01-01T00:00:00Z":
         return "N/A"
     try:
-        dt = datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
+        return format_iso(date_str, "%Y-%m-%d %H:%M:%S")
     except:
         return date_str
 
+# Unit thresholds in seconds, and the divisor/suffix for each bucket
+_TTL_BOUNDS = (60, 3600, 86400)
+_TTL_DIVISORS = (1, 60, 3600, 86400)
+_TTL_UNITS = ('s', 'm', 'h', 'd')
+
 def format_ttl(ms):
     """Format TTL from milliseconds to a human-readable format"""
     if not ms:
         return "N/A"
     
-    seconds = ms / 1000  # Convert milliseconds to seconds
-    
-    if seconds < 60:
-        return f"{int(seconds)}s"
-    
-    minutes = seconds / 60
-    if minutes < 60:
-        return f"{int(minutes)}m"
-    
-    hours = minutes / 60
-    if hours < 24:
-        return f"{int(hours)}h"
-    
-    days = hours / 24
-    return f"{int(days)}d"
+    seconds = ms / 1000
+    i = bisect.bisect_right(_TTL_BOUNDS, seconds)
+    return f"{int(seconds / _TTL_DIVISORS[i])}{_TTL_UNITS[i]}"
 
-def format_time_remaining(deadline):
-    """Format time remaining until workspace stops"""
+def format_time_remaining(deadline, now=None):
+    """Format time remaining until workspace stops, relative to `now` (defaults to the current time)"""
     if not deadline or deadline == "N/A":
         return "N/A"
     
     try:
-        dt = datetime.datetime.fromisoformat(deadline.replace('Z', '+00:00'))
-        now = datetime.datetime.now(timezone.utc)
+        dt = parse_iso(deadline)
+        if now is None:
+            now = datetime.datetime.now(timezone.utc)
         remaining = dt - now
         
         if remaining.total_seconds() < 0:
@@ -124,7 +111,6 @@ def format_time_remaining(deadline):
 
 def main():
     # Get data
-    audit_logs = get_audit_logs()
     workspaces = get_workspaces()
     templates = get_templates()
     
@@ -137,6 +123,9 @@ def main():
     # Prepare data for display
     table_data = []
     
+    # One reference time for the whole table rather than one per row
+    now = datetime.datetime.now(timezone.utc)
+    
     for workspace in workspaces:
         if workspace['latest_build']['status'] == 'running':
             username = workspace['owner_name']
@@ -146,7 +135,7 @@ def main():
             last_seen = format_date(workspace['owner'].get('last_seen_at', 'N/A') if 'owner' in workspace else workspace.get('last_used_at', 'N/A'))
             ttl_default = format_ttl(workspace.get('ttl_ms'))
             deadline = format_date(workspace['latest_build'].get('deadline', 'N/A'))
-            until_stop = format_time_remaining(workspace['latest_build'].get('deadline'))
+            until_stop = format_time_remaining(workspace['latest_build'].get('deadline'), now)
             max_deadline = format_date(workspace['latest_build'].get('max_deadline', 'N/A'))
             
             table_data.append([
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Coder API cache helpers
+
+An on-disk TTL cache of Coder API GET responses, shared between runs.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+from coder_api import response_json
+
+# Where cached_get keeps its responses; CODER_CACHE_TTL caps every TTL (0 disables),
+# and setting CODER_CACHE_STATS prints hit/miss counts to stderr at exit
+DISK_CACHE_DIR = os.path.expanduser("~/.cache/coder-audit")
+CACHE_STATS = Counter()
+
+
+def _disk_cache_ttl(ttl_seconds):
+    """Apply the CODER_CACHE_TTL cap to a per-endpoint TTL"""
+    override = os.environ.get("CODER_CACHE_TTL")
+    if override is None:
+        return ttl_seconds
+    try:
+        return min(ttl_seconds, int(override))
+    except ValueError:
+        return ttl_seconds
+
+
+def _disk_cache_path(session, url):
+    """Cache file for a URL, keyed by the URL and the session's token"""
+    token = session.headers.get("Coder-Session-Token") or ""
+    digest = hashlib.sha256(f"{url}|{token}".encode()).hexdigest()
+    return os.path.join(DISK_CACHE_DIR, f"{digest}.json")
+
+
+def _write_disk_cache(path, entry):
+    """Atomically replace a cache file, ignoring an unwritable cache directory"""
+    try:
+        os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def cached_get(session, url, ttl_seconds):
+    """
+    GET `url` with `session` and return (status_code, decoded body), serving
+    the body from disk while the cached copy is younger than `ttl_seconds`.
+    A stale copy with an ETag is revalidated with If-None-Match, so an
+    unchanged resource costs a bodiless 304 instead of a full download.
+    Only 200 responses are cached; the body is None for any other status.
+    """
+    ttl_seconds = _disk_cache_ttl(ttl_seconds)
+    path = _disk_cache_path(session, url)
+
+    entry = None
+    if ttl_seconds > 0:
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            # A truncated or hand-edited file may hold valid JSON of the wrong shape
+            if not isinstance(entry, dict) or "body" not in entry:
+                raise ValueError("malformed cache entry")
+            if time.time() - entry["fetched_at"] < ttl_seconds:
+                CACHE_STATS["hit"] += 1
+                return 200, entry["body"]
+        except (OSError, ValueError, KeyError, TypeError):
+            entry = None
+
+    etag = entry.get("etag") if entry else None
+    response = session.get(url, headers={"If-None-Match": etag} if etag else None)
+    if response.status_code == 304 and etag:
+        CACHE_STATS["revalidated"] += 1
+        entry["fetched_at"] = time.time()
+        _write_disk_cache(path, entry)
+        return 200, entry["body"]
+
+    CACHE_STATS["miss"] += 1
+    if response.status_code != 200:
+        return response.status_code, None
+    body = response_json(response)
+
+    if ttl_seconds > 0:
+        _write_disk_cache(path, {"fetched_at": time.time(), "etag": response.headers.get("ETag"), "body": body})
+    return 200, body
+
+
+@atexit.register
+def _report_cache_stats():
+    if CACHE_STATS and os.environ.get("CODER_CACHE_STATS"):
+        print(f"HTTP cache: {CACHE_STATS['hit']} hit(s), {CACHE_STATS['revalidated']} revalidated, "
+              f"{CACHE_STATS['miss']} miss(es)", file=sys.stderr)
@@ -8,16 +8,28 @@ Provides comprehensive activity information using Coder's insights API endpoints
 - /api/v2/insights/user-activity
 """
 
-import requests
 import json
 import datetime
+import functools
+import bisect
 from datetime import timezone, timedelta
 import os
+import io
 import sys
 from tabulate import tabulate
 from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+
+from coder_api import parse_iso, format_iso, response_json, build_session
+from coder_cache import cached_get
+
+# Seconds the templates and workspaces lists may be served from the on-disk cache
+TEMPLATES_CACHE_TTL = 300
+WORKSPACES_CACHE_TTL = 30
 
 # Get the API token from file or environment variable
+@functools.lru_cache(maxsize=1)
 def get_token():
     if os.path.exists("audit-token.txt"):
         with open("audit-token.txt", "r") as f:
@@ -36,20 +48,19 @@ def get_fqdn():
 
 FQDN = get_fqdn()
 CODER_URL = f"{FQDN}"
-TOKEN = get_token()
 
-headers = {
-    'Accept': 'application/json',
-    'Coder-Session-Token': TOKEN
-}
+@functools.lru_cache(maxsize=1)
+def _session():
+    """Build the shared API session on first use so every call reuses its pooled connection"""
+    return build_session(get_token())
 
 def get_user_status_counts():
     """Get user status counts from insights API"""
     url = f"{CODER_URL}/api/v2/insights/user-status-counts"
     try:
-        response = requests.get(url, headers=headers)
+        response = _session().get(url)
         if response.status_code == 200:
-            return response.json()
+            return response_json(response)
         else:
             print(f"Error fetching user status counts: {response.status_code}")
             return None
@@ -61,11 +72,11 @@ def get_all_workspaces():
     """Get all workspaces from the API"""
     url = f"{CODER_URL}/api/v2/workspaces"
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            return response.json().get("workspaces", [])
+        status_code, data = cached_get(_session(), url, ttl_seconds=WORKSPACES_CACHE_TTL)
+        if status_code == 200:
+            return data.get("workspaces", [])
         else:
-            print(f"Error fetching workspaces: {response.status_code}")
+            print(f"Error fetching workspaces: {status_code}")
             return []
     except Exception as e:
         print(f"Error connecting to workspaces API: {e}")
@@ -75,9 +86,9 @@ def get_workspace_details(workspace_id):
     """Get detailed information about a specific workspace"""
     url = f"{CODER_URL}/api/v2/workspaces/{workspace_id}"
     try:
-        response = requests.get(url, headers=headers)
+        response = _session().get(url)
         if response.status_code == 200:
-            return response.json()
+            return response_json(response)
         else:
             print(f"Error fetching workspace {workspace_id}: {response.status_code}")
             return None
@@ -98,9 +109,9 @@ def get_user_activity(start_date=None, end_date=None):
     
     url = f"{CODER_URL}/api/v2/insights/user-activity?start_time={start_encoded}&end_time={end_encoded}"
     try:
-        response = requests.get(url, headers=headers)
+        response = _session().get(url)
         if response.status_code == 200:
-            return response.json()
+            return response_json(response)
         else:
             print(f"Error fetching user activity: {response.status_code} - {response.text}")
             return None
@@ -112,24 +123,26 @@ def get_templates():
     """Fetch templates from Coder API"""
     url = f"{CODER_URL}/api/v2/templates"
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            return response.json()
+        status_code, templates = cached_get(_session(), url, ttl_seconds=TEMPLATES_CACHE_TTL)
+        if status_code == 200:
+            return templates
         else:
-            print(f"Error fetching templates: {response.status_code}")
+            print(f"Error fetching templates: {status_code}")
             return []
     except Exception as e:
         print(f"Error connecting to templates API: {e}")
         return []
 
-def format_time_remaining(deadline):
-    """Format time remaining until workspace stops"""
+
+def format_time_remaining(deadline, now=None):
+    """Format time remaining until workspace stops, relative to `now` (defaults to the current time)"""
     if not deadline or deadline == "N/A":
         return "N/A"
     
     try:
-        dt = datetime.datetime.fromisoformat(deadline.replace('Z', '+00:00'))
-        now = datetime.datetime.now(timezone.utc)
+        dt = parse_iso(deadline)
+        if now is None:
+            now = datetime.datetime.now(timezone.utc)
         remaining = dt - now
         
         if remaining.total_seconds() < 0:
@@ -148,47 +161,38 @@ def format_time_remaining(deadline):
     except:
         return "Invalid"
 
+# Unit thresholds in seconds, and the divisor/suffix for each bucket
+_TTL_BOUNDS = (60, 3600, 86400)
+_TTL_DIVISORS = (1, 60, 3600, 86400)
+_TTL_UNITS = ('s', 'm', 'h', 'd')
+
 def format_ttl(ms):
     """Format TTL from milliseconds to human-readable format"""
     if not ms:
         return "N/A"
     
     seconds = ms / 1000
-    
-    if seconds < 60:
-        return f"{int(seconds)}s"
-    
-    minutes = seconds / 60
-    if minutes < 60:
-        return f"{int(minutes)}m"
-    
-    hours = minutes / 60
-    if hours < 24:
-        return f"{int(hours)}h"
-    
-    days = hours / 24
-    return f"{int(days)}d"
+    i = bisect.bisect_right(_TTL_BOUNDS, seconds)
+    return f"{int(seconds / _TTL_DIVISORS[i])}{_TTL_UNITS[i]}"
 
 def format_date(date_str):
     """Format date string to readable format"""
     if not date_str or date_str == "0001-01-01T00:00:00Z":
         return "N/A"
     try:
-        dt = datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
+        return format_iso(date_str, "%Y-%m-%d %H:%M:%S")
     except:
         return date_str
 
-def display_user_status_summary():
+def display_user_status_summary(status_counts, buf):
     """Display user status summary"""
-    print("\n" + "="*80)
-    print("CODER ACTIVITY DASHBOARD")
-    print("="*80)
+    print("\n" + "="*80, file=buf)
+    print("CODER ACTIVITY DASHBOARD", file=buf)
+    print("="*80, file=buf)
     
-    status_counts = get_user_status_counts()
     if status_counts:
-        print("\n📊 USER STATUS SUMMARY:")
-        print("-" * 40)
+        print("\n📊 USER STATUS SUMMARY:", file=buf)
+        print("-" * 40, file=buf)
         
         # Display status counts
         status_table = []
@@ -196,46 +200,40 @@ def display_user_status_summary():
             status_table.append([status.replace('_', ' ').title(), count])
         
         if status_table:
-            print(tabulate(status_table, headers=["Status", "Count"], tablefmt="simple"))
+            print(tabulate(status_table, headers=["Status", "Count"], tablefmt="simple"), file=buf)
         else:
-            print("No status data available")
+            print("No status data available", file=buf)
     else:
-        print("❌ Could not fetch user status counts")
+        print("❌ Could not fetch user status counts", file=buf)
 
-def display_workspace_summary():
+def display_workspace_summary(workspaces, templates, buf):
     """Display workspace summary"""
-    print("\n\n💻 WORKSPACE SUMMARY:")
-    print("-" * 40)
+    print("\n\n💻 WORKSPACE SUMMARY:", file=buf)
+    print("-" * 40, file=buf)
     
-    workspaces = get_all_workspaces()
-    templates = get_templates()
     template_map = {tpl['id']: tpl['name'] for tpl in templates}
     
     if not workspaces:
-        print("No workspaces found")
+        print("No workspaces found", file=buf)
         return
     
-    # Count workspaces by status
-    status_counts = {}
-    template_counts = {}
+    # Count workspaces by status and template
+    status_counts = Counter(ws.get('latest_build', {}).get('status', 'unknown') for ws in workspaces)
+    template_counts = Counter(template_map.get(ws.get('template_id'), 'Unknown') for ws in workspaces)
     
     workspace_table = []
     
+    # Only show running workspaces in detail, all relative to one reference time
+    now = datetime.datetime.now(timezone.utc)
     for ws in workspaces:
         status = ws.get('latest_build', {}).get('status', 'unknown')
-        template_id = ws.get('template_id')
-        template_name = template_map.get(template_id, 'Unknown')
-        
-        status_counts[status] = status_counts.get(status, 0) + 1
-        template_counts[template_name] = template_counts.get(template_name, 0) + 1
-        
-        # Only show running workspaces in detail
         if status == 'running':
+            template_name = template_map.get(ws.get('template_id'), 'Unknown')
             owner = ws.get('owner_name', 'Unknown')
             name = ws.get('name', 'Unknown')
             ttl = format_ttl(ws.get('ttl_ms'))
             deadline = ws.get('latest_build', {}).get('deadline')
-            until_stop = format_time_remaining(deadline)
+            until_stop = format_time_remaining(deadline, now)
             
             workspace_table.append([
                 owner,
@@ -247,44 +245,46 @@ def display_workspace_summary():
             ])
     
     # Display status summary
-    print("Status Distribution:")
+    print("Status Distribution:", file=buf)
     status_summary = [[status.title(), count] for status, count in status_counts.items()]
-    print(tabulate(status_summary, headers=["Status", "Count"], tablefmt="simple"))
+    print(tabulate(status_summary, headers=["Status", "Count"], tablefmt="simple"), file=buf)
     
-    print("\nTemplate Distribution:")
+    print("\nTemplate Distribution:", file=buf)
     template_summary = [[template, count] for template, count in template_counts.items()]
-    print(tabulate(template_summary, headers=["Template", "Count"], tablefmt="simple"))
+    print(tabulate(template_summary, headers=["Template", "Count"], tablefmt="simple"), file=buf)
     
     # Display running workspaces in detail
     if workspace_table:
-        print("\n🟢 RUNNING WORKSPACES:")
-        print("-" * 40)
+        print("\n🟢 RUNNING WORKSPACES:", file=buf)
+        print("-" * 40, file=buf)
         workspace_table.sort(key=lambda x: (x[0].lower(), x[1].lower()))
         headers = ["Owner", "Workspace", "Template", "Status", "TTL", "Until Stop"]
-        print(tabulate(workspace_table, headers=headers, tablefmt="grid"))
+        print(tabulate(workspace_table, headers=headers, tablefmt="grid"), file=buf)
     else:
-        print("\n✅ No running workspaces found")
+        print("\n✅ No running workspaces found", file=buf)
 
-def display_user_activity():
-    """Display user activity information"""
-    print("\n\n📈 USER ACTIVITY (Last 30 Days):")
-    print("-" * 40)
-    
-    # Try different date ranges to see if we get data
-    date_ranges = [
-        (30, "Last 30 Days"),
-        (7, "Last 7 Days"),
-        (1, "Last 24 Hours")
-    ]
+# Date ranges tried in order until one returns activity data
+ACTIVITY_DATE_RANGES = [
+    (30, "Last 30 Days"),
+    (7, "Last 7 Days"),
+    (1, "Last 24 Hours")
+]
+
+def activity_date_range(days):
+    """Return (start_date, end_date) strings covering the last `days` days"""
+    now = datetime.datetime.now(timezone.utc)
+    start_date = (now - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    end_date = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return start_date, end_date
+
+def display_user_activity(activity_results, buf):
+    """Display user activity information, one result per ACTIVITY_DATE_RANGES entry"""
+    print("\n\n📈 USER ACTIVITY (Last 30 Days):", file=buf)
+    print("-" * 40, file=buf)
     
-    for days, label in date_ranges:
-        start_date = (datetime.datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%SZ')
-        end_date = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-        
-        activity_data = get_user_activity(start_date, end_date)
-        
+    for (days, label), activity_data in zip(ACTIVITY_DATE_RANGES, activity_results):
         if activity_data and activity_data.get('report', {}).get('users'):
-            print(f"\n{label}:")
+            print(f"\n{label}:", file=buf)
             users = activity_data['report']['users']
             
             activity_table = []
@@ -293,27 +293,43 @@ def display_user_activity():
                 activity_table.append([username, "Active"])
             
             if activity_table:
-                print(tabulate(activity_table, headers=["Username", "Activity"], tablefmt="simple"))
+                print(tabulate(activity_table, headers=["Username", "Activity"], tablefmt="simple"), file=buf)
             break
         else:
-            print(f"No activity data for {label.lower()}")
+            print(f"No activity data for {label.lower()}", file=buf)
     else:
-        print("❌ No user activity data available for any time range")
-        print("This might indicate:")
-        print("  • No user activity in the specified periods")
-        print("  • Insufficient permissions to access activity data")
-        print("  • Activity tracking may not be enabled")
+        print("❌ No user activity data available for any time range", file=buf)
+        print("This might indicate:", file=buf)
+        print("  • No user activity in the specified periods", file=buf)
+        print("  • Insufficient permissions to access activity data", file=buf)
+        print("  • Activity tracking may not be enabled", file=buf)
 
 def main():
     """Main dashboard function"""
     try:
-        display_user_status_summary()
-        display_workspace_summary()
-        display_user_activity()
+        # Resolve the token up front so a missing one exits before fanning out
+        _session()
+        
+        # The endpoints are independent, so fetch them concurrently
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            status_future = executor.submit(get_user_status_counts)
+            workspaces_future = executor.submit(get_all_workspaces)
+            templates_future = executor.submit(get_templates)
+            activity_futures = [
+                executor.submit(get_user_activity, *activity_date_range(days))
+                for days, _ in ACTIVITY_DATE_RANGES
+            ]
+        
+        # Render the whole dashboard into memory and write it out in one go
+        buf = io.StringIO()
+        display_user_status_summary(status_future.result(), buf)
+        display_workspace_summary(workspaces_future.result(), templates_future.result(), buf)
+        display_user_activity([future.result() for future in activity_futures], buf)
         
-        print("\n" + "="*80)
-        print(f"Dashboard updated: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("="*80 + "\n")
+        print("\n" + "="*80, file=buf)
+        print(f"Dashboard updated: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", file=buf)
+        print("="*80 + "\n", file=buf)
+        sys.stdout.write(buf.getvalue())
         
     except KeyboardInterrupt:
         print("\n\n⚠️  Dashboard interrupted by user")
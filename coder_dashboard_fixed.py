@@ -8,48 +8,46 @@ Provides comprehensive activity information using Coder's insights API endpoints
 - /api/v2/insights/user-activity
 """
 
-import requests
 import json
 import datetime
+import functools
 from datetime import timezone, timedelta
 import os
+import io
 import sys
 from tabulate import tabulate
 from urllib.parse import quote
+from collections import Counter
+
+from coder_api import fromisoformat, response_json, build_session
 
 # Get the API token from file or environment variable
+@functools.lru_cache(maxsize=1)
 def get_token():
     if os.path.exists("audit-token.txt"):
         with open("audit-token.txt", "r") as f:
             return f.read().strip()
-    token = os.environ.get("CODER_TOKEN")
-    if token:
-        return token
-    print("You must provide a CODER_TOKEN or audit-token.txt")
-    sys.exit(1)
+    return os.environ.get("CODER_TOKEN")
 
+@functools.lru_cache(maxsize=1)
 def get_fqdn():
     if os.environ.get("CODER_URL"):
         return os.environ.get("CODER_URL")
     print("Use CODER_URL ENV to pass your FQDN")
     return "FQDN"
 
-FQDN = get_fqdn()
-CODER_URL = f"{FQDN}"
-TOKEN = get_token()
-
-headers = {
-    'Accept': 'application/json',
-    'Coder-Session-Token': TOKEN
-}
+@functools.lru_cache(maxsize=1)
+def _session():
+    """Build the shared session on first use"""
+    return build_session(get_token())
 
 def get_user_status_counts():
     """Get user status counts from insights API"""
-    url = f"{CODER_URL}/api/v2/insights/user-status-counts"
+    url = f"{get_fqdn()}/api/v2/insights/user-status-counts"
     try:
-        response = requests.get(url, headers=headers)
+        response = _session().get(url)
         if response.status_code == 200:
-            return response.json()
+            return response_json(response)
         else:
             print(f"Error fetching user status counts: {response.status_code}")
             return None
@@ -59,11 +57,11 @@ def get_user_status_counts():
 
 def get_all_workspaces():
     """Get all workspaces from the API"""
-    url = f"{CODER_URL}/api/v2/workspaces"
+    url = f"{get_fqdn()}/api/v2/workspaces"
     try:
-        response = requests.get(url, headers=headers)
+        response = _session().get(url)
         if response.status_code == 200:
-            return response.json().get("workspaces", [])
+            return response_json(response).get("workspaces", [])
         else:
             print(f"Error fetching workspaces: {response.status_code}")
             return []
@@ -86,12 +84,12 @@ def get_user_activity(start_date=None, end_date=None):
     start_encoded = quote(start_date)
     end_encoded = quote(end_date)
     
-    url = f"{CODER_URL}/api/v2/insights/user-activity?start_time={start_encoded}&end_time={end_encoded}"
+    url = f"{get_fqdn()}/api/v2/insights/user-activity?start_time={start_encoded}&end_time={end_encoded}"
     print(f"URL is {url}")
     try:
-        response = requests.get(url, headers=headers)
+        response = _session().get(url)
         if response.status_code == 200:
-            return response.json()
+            return response_json(response)
         else:
             print(f"Error fetching user activity: {response.status_code} - {response.text}")
             return None
@@ -101,11 +99,11 @@ def get_user_activity(start_date=None, end_date=None):
 
 def get_templates():
     """Fetch templates from Coder API"""
-    url = f"{CODER_URL}/api/v2/templates"
+    url = f"{get_fqdn()}/api/v2/templates"
     try:
-        response = requests.get(url, headers=headers)
+        response = _session().get(url)
         if response.status_code == 200:
-            return response.json()
+            return response_json(response)
         else:
             print(f"Error fetching templates: {response.status_code}")
             return []
@@ -113,14 +111,15 @@ def get_templates():
         print(f"Error connecting to templates API: {e}")
         return []
 
-def format_time_remaining(deadline):
-    """Format time remaining until workspace stops"""
+def format_time_remaining(deadline, now=None):
+    """Format time remaining until workspace stops, relative to `now` (defaults to the current time)"""
     if not deadline or deadline == "N/A":
         return "N/A"
     
     try:
-        dt = datetime.datetime.fromisoformat(deadline.replace('Z', '+00:00'))
-        now = datetime.datetime.now(timezone.utc)
+        dt = fromisoformat(deadline)
+        if now is None:
+            now = datetime.datetime.now(timezone.utc)
         remaining = dt - now
         
         if remaining.total_seconds() < 0:
@@ -139,6 +138,7 @@ def format_time_remaining(deadline):
     except:
         return "Invalid"
 
+@functools.lru_cache(maxsize=1024)
 def format_ttl(ms):
     """Format TTL from milliseconds to human-readable format"""
     if not ms:
@@ -165,7 +165,7 @@ def format_date(date_str):
     if not date_str or date_str == "0001-01-01T00:00:00Z":
         return "N/A"
     try:
-        dt = datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        dt = fromisoformat(date_str)
         return dt.strftime("%Y-%m-%d %H:%M:%S")
     except:
         return date_str
@@ -186,16 +186,16 @@ def parse_user_status_counts(status_data):
     
     return latest_counts
 
-def display_user_status_summary():
+def display_user_status_summary(buf):
     """Display user status summary"""
-    print("\n" + "="*80)
-    print("🎯 CODER ACTIVITY DASHBOARD")
-    print("="*80)
+    print("\n" + "="*80, file=buf)
+    print("🎯 CODER ACTIVITY DASHBOARD", file=buf)
+    print("="*80, file=buf)
     
     status_counts = get_user_status_counts()
     if status_counts:
-        print("\n📊 USER STATUS SUMMARY:")
-        print("-" * 40)
+        print("\n📊 USER STATUS SUMMARY:", file=buf)
+        print("-" * 40, file=buf)
         
         # Parse the complex data structure
         parsed_counts = parse_user_status_counts(status_counts)
@@ -210,85 +210,73 @@ def display_user_status_summary():
             total_users += count
         
         if status_table:
-            print(tabulate(status_table, headers=["Status", "Count"], tablefmt="simple"))
-            print(f"\nTotal Users: {total_users}")
+            print(tabulate(status_table, headers=["Status", "Count"], tablefmt="simple"), file=buf)
+            print(f"\nTotal Users: {total_users}", file=buf)
         else:
-            print("No status data available")
+            print("No status data available", file=buf)
     else:
-        print("❌ Could not fetch user status counts")
+        print("❌ Could not fetch user status counts", file=buf)
 
-def display_workspace_summary():
+def display_workspace_summary(buf):
     """Display workspace summary"""
-    print("\n\n💻 WORKSPACE SUMMARY:")
-    print("-" * 40)
+    print("\n\n💻 WORKSPACE SUMMARY:", file=buf)
+    print("-" * 40, file=buf)
     
     workspaces = get_all_workspaces()
     templates = get_templates()
     template_map = {tpl['id']: tpl['name'] for tpl in templates}
     
     if not workspaces:
-        print("No workspaces found")
+        print("No workspaces found", file=buf)
         return
     
-    # Count workspaces by status
-    status_counts = {}
-    template_counts = {}
+    # Count workspaces by status and template
+    statuses = [ws.get('latest_build', {}).get('status', 'unknown') for ws in workspaces]
+    status_counts = Counter(statuses)
+    template_counts = Counter(template_map.get(ws.get('template_id'), 'Unknown') for ws in workspaces)
     
-    workspace_table = []
-    
-    for ws in workspaces:
-        status = ws.get('latest_build', {}).get('status', 'unknown')
-        template_id = ws.get('template_id')
-        template_name = template_map.get(template_id, 'Unknown')
-        
-        status_counts[status] = status_counts.get(status, 0) + 1
-        template_counts[template_name] = template_counts.get(template_name, 0) + 1
-        
-        # Only show running workspaces in detail
-        if status == 'running':
-            owner = ws.get('owner_name', 'Unknown')
-            name = ws.get('name', 'Unknown')
-            ttl = format_ttl(ws.get('ttl_ms'))
-            deadline = ws.get('latest_build', {}).get('deadline')
-            until_stop = format_time_remaining(deadline)
-            
-            workspace_table.append([
-                owner,
-                name,
-                template_name,
-                status.title(),
-                ttl,
-                until_stop
-            ])
+    # Only show running workspaces in detail, all relative to one reference time
+    now = datetime.datetime.now(timezone.utc)
+    workspace_table = [
+        [
+            ws.get('owner_name', 'Unknown'),
+            ws.get('name', 'Unknown'),
+            template_map.get(ws.get('template_id'), 'Unknown'),
+            'Running',
+            format_ttl(ws.get('ttl_ms')),
+            format_time_remaining(ws.get('latest_build', {}).get('deadline'), now)
+        ]
+        for ws, status in zip(workspaces, statuses) if status == 'running'
+    ]
     
     # Display status summary
-    print("Status Distribution:")
+    print("Status Distribution:", file=buf)
     status_summary = [[status.title(), count] for status, count in sorted(status_counts.items())]
-    print(tabulate(status_summary, headers=["Status", "Count"], tablefmt="simple"))
+    print(tabulate(status_summary, headers=["Status", "Count"], tablefmt="simple"), file=buf)
     
     # Display running workspaces in detail
     if workspace_table:
-        print("\n🟢 RUNNING WORKSPACES:")
-        print("-" * 60)
+        print("\n🟢 RUNNING WORKSPACES:", file=buf)
+        print("-" * 60, file=buf)
         workspace_table.sort(key=lambda x: (x[0].lower(), x[1].lower()))
         headers = ["Owner", "Workspace", "Template", "Status", "TTL", "Until Stop"]
-        print(tabulate(workspace_table, headers=headers, tablefmt="grid"))
+        print(tabulate(workspace_table, headers=headers, tablefmt="grid"), file=buf)
     else:
-        print("\n✅ No running workspaces found")
+        print("\n✅ No running workspaces found", file=buf)
     
     # Display top templates
     if template_counts:
-        print("\n📋 TOP TEMPLATES:")
-        print("-" * 40)
+        print("\n📋 TOP TEMPLATES:", file=buf)
+        print("-" * 40, file=buf)
         # Sort by count and take top 10
         top_templates = sorted(template_counts.items(), key=lambda x: x[1], reverse=True)[:10]
         template_summary = [[template, count] for template, count in top_templates]
-        print(tabulate(template_summary, headers=["Template", "Count"], tablefmt="simple"))
+        print(tabulate(template_summary, headers=["Template", "Count"], tablefmt="simple"), file=buf)
 
-def display_user_activity():
+def display_user_activity(buf):
     """Display user activity information"""
-    print("\n\n📈 USER ACTIVITY:")
-    print("-" * 40)
+    print("\n\n📈 USER ACTIVITY:", file=buf)
+    print("-" * 40, file=buf)
     
     # Try to get activity data with properly formatted dates
     activity_data = get_user_activity()
@@ -296,7 +284,7 @@ def display_user_activity():
     if activity_data and activity_data.get('report', {}).get('users'):
         users = activity_data['report']['users']
         
-        print(f"Activity report from {activity_data['report']['start_time'][:10]} to {activity_data['report']['end_time'][:10]}")
+        print(f"Activity report from {activity_data['report']['start_time'][:10]} to {activity_data['report']['end_time'][:10]}", file=buf)
         
         activity_table = []
         for user in users:
@@ -305,26 +293,33 @@ def display_user_activity():
             activity_table.append([username, "Active"])
         
         if activity_table:
-            print(tabulate(activity_table, headers=["Username", "Status"], tablefmt="simple"))
+            print(tabulate(activity_table, headers=["Username", "Status"], tablefmt="simple"), file=buf)
         else:
-            print("No users found in activity report")
+            print("No users found in activity report", file=buf)
     else:
-        print("❌ No user activity data available")
-        print("This might indicate:")
-        print("  • No user activity in the specified period")
-        print("  • Insufficient permissions to access activity data")
-        print("  • Activity tracking may not be enabled")
+        print("❌ No user activity data available", file=buf)
+        print("This might indicate:", file=buf)
+        print("  • No user activity in the specified period", file=buf)
+        print("  • Insufficient permissions to access activity data", file=buf)
+        print("  • Activity tracking may not be enabled", file=buf)
 
 def main():
     """Main dashboard function"""
+    if not get_token():
+        print("You must provide a CODER_TOKEN or audit-token.txt")
+        sys.exit(1)
+
     try:
-        display_user_status_summary()
-        display_workspace_summary()
-        display_user_activity()
+        # Render the whole dashboard into memory and write it out in one go
+        buf = io.StringIO()
+        display_user_status_summary(buf)
+        display_workspace_summary(buf)
+        display_user_activity(buf)
         
-        print("\n" + "="*80)
-        print(f"📅 Dashboard updated: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("="*80 + "\n")
+        print("\n" + "="*80, file=buf)
+        print(f"📅 Dashboard updated: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", file=buf)
+        print("="*80 + "\n", file=buf)
+        sys.stdout.write(buf.getvalue())
         
     except KeyboardInterrupt:
         print("\n\n⚠️  Dashboard interrupted by user")
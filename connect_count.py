@@ -3,14 +3,16 @@
 # Creates two distinct tables, total login/connect between two dates and a connect_count per user
 # requirements: prettytable
 #
-import requests
 import json
 import datetime
 import os
 import argparse
 from urllib.parse import urlencode
 from prettytable import PrettyTable
-from collections import defaultdict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from coder_api import response_json, build_session
 
 # Get the API token from file or environment variable
 def get_token():
@@ -27,107 +29,128 @@ def parse_args():
     parser.add_argument('--end', required=True, help='End time (YYYY-MM-DD)')
     return parser.parse_args()
 
-def get_connection_data(coder_url, token, start_date, end_date):
+# Number of day ranges fetched concurrently, and audit records per page
+PARALLEL_WINDOWS = 8
+PAGE_LIMIT = 500
+
+# In v2, we need to check multiple connection actions
+CONNECTION_ACTIONS = frozenset({
+    'login',
+    'start_workspace_connection',
+    'start',
+    'connect_workspace',
+    'workspace_connection',
+    'workspace.connect'  # Add more if needed
+})
+
+def split_date_range(start_date, end_date, windows):
     """
-    Retrieve and analyze connection events within a date range using the v2 API
+    Split the days from start_date to end_date (inclusive) into up to `windows`
+    disjoint (date_from, date_to) day ranges, both ends inclusive
     """
-    headers = {
-        'Accept': 'application/json',
-        'Coder-Session-Token': token
-    }
+    first_day = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+    days = (datetime.datetime.strptime(end_date, "%Y-%m-%d") - first_day).days + 1
+    windows = max(1, min(windows, days))
 
-    # Convert dates to ISO format and add time boundaries
-    start_iso = f"{start_date}T00:00:00Z"
-    end_iso = f"{end_date}T23:59:59Z"
-    
+    # Window i starts on day bounds[i] and ends the day before the next window starts
+    bounds = [(days * i) // windows for i in range(windows + 1)]
+    return [
+        ((first_day + datetime.timedelta(days=bounds[i])).strftime("%Y-%m-%d"),
+         (first_day + datetime.timedelta(days=bounds[i + 1] - 1)).strftime("%Y-%m-%d"))
+        for i in range(windows)
+    ]
+
+def count_window(session, coder_url, date_from, date_to):
+    """
+    Page through the audit logs of one day range and count its connection events
+    """
     # Track all actions
-    action_counts = defaultdict(int)
+    action_counts = Counter()
     
     # Track login events by user
-    login_counts = defaultdict(int)
+    login_counts = Counter()
     
     # Keep track of connections
     connection_count = 0
-    after_id = None
-    previous_after_id = None  # Track previous after_id to detect loops
-    
-    # In v2, we need to check multiple connection actions
-    connection_actions = [
-        'login',
-        'start_workspace_connection',
-        'start',
-        'connect_workspace',
-        'workspace_connection',
-        'workspace.connect'  # Add more if needed
-    ]
-    
-    all_logs = []
+    offset = 0
+    seen_ids = set()  # Ids already tallied; rows written mid-walk shift later pages onto them
     
     while True:
-        # Check if we're stuck in a loop
-        if after_id == previous_after_id and after_id is not None:
-            print(f"Breaking out of loop - same after_id encountered twice: {after_id}")
-            break
-            
-        previous_after_id = after_id
-        
-        # Build params for fetching audit logs with filters
+        # The audit API filters dates through its search query and pages by offset
         params = {
-            'limit': 100,                   # Fetch 100 records at a time
-            'after_time': start_iso,        # Start of time range
-            'before_time': end_iso,         # End of time range
+            'limit': PAGE_LIMIT,
+            'offset': offset,
+            'q': f"date_from:{date_from} date_to:{date_to}",
         }
         
-        # Add after_id parameter only if we have one
-        if after_id:
-            params['after_id'] = after_id
-        
         # Make the API request
         url = f"{coder_url}/api/v2/audit"
         print(f"Fetching page from {url} with params: {params}")
         
-        response = requests.get(url, headers=headers, params=params)
+        response = session.get(url, params=params)
         
         if response.status_code != 200:
             print(f"Error fetching audit logs: {response.status_code}")
             print(response.text)
             break
         
-        data = response.json()
+        data = response_json(response)
         logs = data.get('audit_logs', [])
         
-        # If we got no logs, we're done
         if not logs:
-            print("No logs found in this batch")
+            print(f"Reached the end of data for {date_from} - {date_to}")
+            break
+        
+        # Only tally rows not seen yet; a page with nothing new means the server is repeating itself
+        new_logs = [log for log in logs if log.get('id') not in seen_ids]
+        if not new_logs:
+            print(f"Breaking out of loop - page at offset {offset} was already processed")
             break
+        seen_ids.update(log.get('id') for log in new_logs)
         
-        # Process logs from this batch
-        for log in logs:
-            action = log.get('action')
-            
-            # Track all actions for the summary table
-            action_counts[action] += 1
-            
-            # Check if this is a login action and track the user
-            if action == 'login':
-                user = log.get('user', {}).get('username', 'unknown')
-                login_counts[user] += 1
-            
-            # Check if the action matches any of our connection actions
-            if action in connection_actions:
-                connection_count += 1
+        # Tally this batch on its own, then merge it into the window totals
+        actions = [log.get('action') for log in new_logs]
+        page_action_counts = Counter(actions)
+        page_login_counts = Counter(
+            log.get('user', {}).get('username', 'unknown')
+            for log, action in zip(new_logs, actions) if action == 'login'
+        )
         
-        print(f"Processed {len(logs)} logs in this batch")
+        # Track all actions for the summary table, and logins per user
+        action_counts += page_action_counts
+        login_counts += page_login_counts
         
-        # Check if we need to fetch the next page
-        if len(logs) < params['limit']:
-            # We received fewer logs than the limit, so we're at the end
-            print("Received fewer logs than requested limit - reached the end of data")
+        # Count the actions that match any of our connection actions
+        connection_count += sum(1 for action in actions if action in CONNECTION_ACTIONS)
+        
+        print(f"Processed {len(new_logs)} logs in this batch ({date_from} - {date_to})")
+        
+        # A short page is the last one
+        if len(logs) < PAGE_LIMIT:
             break
-            
-        # Use the ID of the last log as the after_id for the next request
-        after_id = logs[-1].get('id')
-        print(f"Next page after_id: {after_id}")
+        offset += len(logs)
+    
+    return connection_count, action_counts, login_counts
+
+def get_connection_data(coder_url, token, start_date, end_date):
+    """
+    Retrieve and analyze connection events within a date range using the v2 API.
+    The range is split into disjoint day ranges whose pages are fetched concurrently.
+    """
+    # One session for every page
+    session = build_session(token)
+
+    windows = split_date_range(start_date, end_date, PARALLEL_WINDOWS)
+    with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+        results = list(executor.map(
+            lambda window: count_window(session, coder_url, *window), windows
+        ))
+    session.close()
+    
+    # The day ranges are disjoint, so each row is tallied by exactly one window
+    connection_count = sum(result[0] for result in results)
+    action_counts = sum((result[1] for result in results), Counter())
+    login_counts = sum((result[2] for result in results), Counter())
     
     return connection_count, action_counts, login_counts
 
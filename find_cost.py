@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
-import requests
 import os
+import functools
+
+from coder_api import response_json, build_session
 
 # Get the API token from file or environment variable
+@functools.lru_cache(maxsize=1)
 def get_token():
     if os.path.exists("audit-token.txt"):
         with open("audit-token.txt", "r") as f:
             return f.read().strip()
     return os.environ.get("CODER_TOKEN")
 
+@functools.lru_cache(maxsize=1)
 def get_fqdn():
     if os.environ.get("CODER_URL"):
       return os.environ.get("CODER_URL")
@@ -17,46 +21,58 @@ def get_fqdn():
     return "FQDN"
 
 
-FQDN = get_fqdn()
-CODER_URL = f"https://{FQDN}"
-TOKEN = get_token()
-
-headers = {
-    'Accept': 'application/json',
-    'Coder-Session-Token': TOKEN
-}
+@functools.lru_cache(maxsize=1)
+def _session():
+    """Build the shared session on first use"""
+    return build_session(get_token())
 
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+# Upper bound on concurrent workspace lookups, to avoid overwhelming the Coder server
+MAX_LOOKUP_WORKERS = 32
+
+# Audit records per page, and the server-side filter for workspace deletions
+AUDIT_PAGE_LIMIT = 500
+DELETE_QUERY = "action:delete"
 
 def get_workspaces():
     """Fetch workspaces from Coder API"""
-    url = f"{CODER_URL}/api/v2/workspaces"
-    response = requests.get(url, headers=headers)
+    url = f"https://{get_fqdn()}/api/v2/workspaces"
+    response = _session().get(url)
     if response.status_code == 200:
-        return response.json()["workspaces"]
+        return response_json(response)["workspaces"]
     else:
         print(f"Error fetching workspaces: {response.status_code}")
         return []
 
 def get_workspace_by_id(workspace_id):
     """Fetch a single workspace by its ID from the Coder API"""
-    url = f"{CODER_URL}/api/v2/workspaces/{workspace_id}"
-    response = requests.get(url, headers=headers)
+    url = f"https://{get_fqdn()}/api/v2/workspaces/{workspace_id}"
+    response = _session().get(url)
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
         return None
 
-def get_audit_logs():
-    """Fetch audit logs from Coder API"""
-    url = f"{CODER_URL}/api/v2/audit?limit=0"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()["audit_logs"]
-    else:
-        print(f"Error fetching audit logs: {response.status_code}")
-        return []
+def get_audit_logs(q=None):
+    """Fetch audit logs from Coder API page by page, optionally filtered server-side by a search query"""
+    url = f"https://{get_fqdn()}/api/v2/audit"
+    audit_logs = []
+    while True:
+        params = {'limit': AUDIT_PAGE_LIMIT, 'offset': len(audit_logs)}
+        if q:
+            params['q'] = q
+        response = _session().get(url, params=params)
+        if response.status_code != 200:
+            print(f"Error fetching audit logs: {response.status_code}")
+            break
+        page = response_json(response)["audit_logs"]
+        audit_logs.extend(page)
+        if len(page) < AUDIT_PAGE_LIMIT:
+            break
+    return audit_logs
 
 def main():
     parser = argparse.ArgumentParser(description="Find workspace costs.")
@@ -65,14 +81,14 @@ def main():
 
     if args.deleted:
         print("Finding costs for deleted workspaces...")
-        audit_logs = get_audit_logs()
+        audit_logs = get_audit_logs(q=DELETE_QUERY)
         if not audit_logs:
             print("No audit logs found.")
             return
 
         deleted_workspaces = []
         for log in audit_logs:
-            if log.get('action') == 'delete' and log.get('resource_type') in ['workspace', 'workspace_build']:
+            if log.get('resource_type') in ['workspace', 'workspace_build']:
                 workspace_id = log.get('additional_fields', {}).get('workspace_id')
                 workspace_name = log.get('additional_fields', {}).get('workspace_name')
                 if not workspace_name:
@@ -83,8 +99,10 @@ def main():
 
         if deleted_workspaces:
             print("Deleted Workspace Costs:")
-            for ws_info in deleted_workspaces:
-                workspace = get_workspace_by_id(ws_info['id'])
+            # Look the workspaces up concurrently; map() keeps the audit log order
+            with ThreadPoolExecutor(max_workers=MAX_LOOKUP_WORKERS) as executor:
+                workspaces = list(executor.map(get_workspace_by_id, [ws_info['id'] for ws_info in deleted_workspaces]))
+            for ws_info, workspace in zip(deleted_workspaces, workspaces):
                 if workspace:
                     cost = workspace.get('latest_build', {}).get('daily_cost')
                     template_name = workspace.get('template_name')
@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
-import requests
 import os
+import functools
+from collections import defaultdict
+
+from coder_api import fromisoformat, response_json, build_session
 
 # Get the API token from file or environment variable
+@functools.lru_cache(maxsize=1)
 def get_token():
     if os.path.exists("audit-token.txt"):
         with open("audit-token.txt", "r") as f:
             return f.read().strip()
     return os.environ.get("CODER_TOKEN")
 
+@functools.lru_cache(maxsize=1)
 def get_fqdn():
     if os.environ.get("CODER_URL"):
       return os.environ.get("CODER_URL")
@@ -17,32 +22,39 @@ def get_fqdn():
     return "FQDN"
 
 
-CODER_URL = get_fqdn()
-TOKEN = get_token()
-
-headers = {
-    'Accept': 'application/json',
-    'Coder-Session-Token': TOKEN
-}
-
-import datetime
-
-def get_audit_logs():
-    """Fetch audit logs from Coder API"""
-    url = f"{CODER_URL}/api/v2/audit?limit=0"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()["audit_logs"]
-    else:
-        print(f"Error fetching audit logs: {response.status_code}")
-        return []
+@functools.lru_cache(maxsize=1)
+def _session():
+    """Build the shared session on first use"""
+    return build_session(get_token())
+
+# Audit records per page, and the server-side filter for workspace deletions
+AUDIT_PAGE_LIMIT = 500
+DELETE_QUERY = "action:delete"
+
+def get_audit_logs(q=None):
+    """Fetch audit logs from Coder API page by page, optionally filtered server-side by a search query"""
+    url = f"{get_fqdn()}/api/v2/audit"
+    audit_logs = []
+    while True:
+        params = {'limit': AUDIT_PAGE_LIMIT, 'offset': len(audit_logs)}
+        if q:
+            params['q'] = q
+        response = _session().get(url, params=params)
+        if response.status_code != 200:
+            print(f"Error fetching audit logs: {response.status_code}")
+            break
+        page = response_json(response)["audit_logs"]
+        audit_logs.extend(page)
+        if len(page) < AUDIT_PAGE_LIMIT:
+            break
+    return audit_logs
 
 def get_users():
     """Fetch users from Coder API"""
-    url = f"{CODER_URL}/api/v2/users"
-    response = requests.get(url, headers=headers)
+    url = f"{get_fqdn()}/api/v2/users"
+    response = _session().get(url)
     if response.status_code == 200:
-        return response.json()["users"]
+        return response_json(response)["users"]
     else:
         print(f"Error fetching users: {response.status_code}")
         return []
@@ -52,23 +64,23 @@ def format_date(date_str):
     if not date_str or date_str == "0001-01-01T00:00:00Z":
         return "N/A"
     try:
-        dt = datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        dt = fromisoformat(date_str)
         return dt.strftime("%Y-%m-%d %H:%M:%S")
     except:
         return date_str
 
 def get_workspaces():
     """Fetch workspaces from Coder API"""
-    url = f"{CODER_URL}/api/v2/workspaces"
-    response = requests.get(url, headers=headers)
+    url = f"{get_fqdn()}/api/v2/workspaces"
+    response = _session().get(url)
     if response.status_code == 200:
-        return response.json()["workspaces"]
+        return response_json(response)["workspaces"]
     else:
         print(f"Error fetching workspaces: {response.status_code}")
         return []
 
 def main():
-    audit_logs = get_audit_logs()
+    audit_logs = get_audit_logs(q=DELETE_QUERY)
     users = get_users()
     workspaces = get_workspaces()
 
@@ -79,39 +91,29 @@ def main():
         } for ws in workspaces
     }
     
-    deleted_by_user = {user['username']: [] for user in users}
-
-    if audit_logs:
-        for log in audit_logs:
-            if log.get('action') == 'delete' and log.get('resource_type') in ['workspace', 'workspace_build']:
-                workspace_name = log.get('additional_fields', {}).get('workspace_name')
-                if not workspace_name:
-                    workspace_name = log.get('resource_target')
-                
-                user = log.get('user', {}).get('username')
-                time = log.get('time')
-
-                if workspace_name and user and time:
-                    if user in deleted_by_user:
-                        template_info = workspace_templates.get(workspace_name, {
-                            'template_name': 'N/A',
-                            'template_display_name': 'N/A'
-                        })
-                        deleted_by_user[user].append({
-                            "name": workspace_name,
-                            "time": format_date(time),
-                            "template_name": template_info['template_name'],
-                            "template_display_name": template_info['template_display_name']
-                        })
-
-    has_deleted_workspaces = any(deleted_by_user.values())
-    if has_deleted_workspaces:
+    known_users = {user['username'] for user in users}
+
+    # One pass over the (server-filtered) delete rows, bucketed by username
+    deleted_by_user = defaultdict(list)
+    for log in audit_logs:
+        if log.get('resource_type') not in ('workspace', 'workspace_build'):
+            continue
+        user = log.get('user', {}).get('username')
+        time = log.get('time')
+        if not user or not time or user not in known_users:
+            continue
+        workspace_name = log.get('additional_fields', {}).get('workspace_name') or log.get('resource_target')
+        if workspace_name:
+            deleted_by_user[user].append((workspace_name, time))
+
+    if deleted_by_user:
         print("Deleted workspaces by user:")
-        for user, deleted_ws in deleted_by_user.items():
-            if deleted_ws:
-                print(f"\nUser: {user}")
-                for ws in deleted_ws:
-                    print(f"- {ws['name']} (at {ws['time']}) (Template: {ws['template_name']} - {ws['template_display_name']})")
+        unknown = {'template_name': 'N/A', 'template_display_name': 'N/A'}
+        for user in sorted(deleted_by_user):
+            print(f"\nUser: {user}")
+            for workspace_name, time in deleted_by_user[user]:
+                template_info = workspace_templates.get(workspace_name, unknown)
+                print(f"- {workspace_name} (at {format_date(time)}) (Template: {template_info['template_name']} - {template_info['template_display_name']})")
 
 if __name__ == "__main__":
     main()
@@ -4,11 +4,14 @@
 # 
 
 import json
-import requests
 import sys
 import os
-from datetime import datetime, timedelta, timezone
-import pprint
+import functools
+import time
+from datetime import timedelta
+
+from coder_api import fromisoformat, response_json, build_session
+from coder_cache import cached_get
 
 # Get the API token from file or environment variable
 def get_token():
@@ -32,139 +35,152 @@ FQDN = get_fqdn()
 CODER_URL = f"{FQDN}"
 TOKEN = get_token()
 
-headers = {
-    'Accept': 'application/json',
-    'Coder-Session-Token': TOKEN
-}
+# Shared session for every request
+SESSION = build_session(TOKEN)
 
-def get_audit_logs(token):
-    url = f"{CODER_URL}/api/v2/audit?limit=0"
+# Seconds the templates list may be served from the on-disk cache; everything else is fetched fresh
+TEMPLATES_CACHE_TTL = 300
 
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Error retrieving audit logs: {response.status_code}")
-        sys.exit(1)
+# Audit records per page, and the server-side filter for workspace start events
+AUDIT_PAGE_LIMIT = 500
+START_QUERY = "resource_type:workspace_build action:start"
 
-    return response.json()
+def get_audit_logs(token):
+    """Fetch the workspace start events page by page, filtered server-side"""
+    url = f"{CODER_URL}/api/v2/audit"
+    audit_logs = []
+    while True:
+        params = {'limit': AUDIT_PAGE_LIMIT, 'offset': len(audit_logs), 'q': START_QUERY}
+        response = SESSION.get(url, params=params)
+        if response.status_code != 200:
+            print(f"Error retrieving audit logs: {response.status_code}")
+            sys.exit(1)
+
+        page = response_json(response).get('audit_logs', [])
+        audit_logs.extend(page)
+        if len(page) < AUDIT_PAGE_LIMIT:
+            break
+
+    return {'audit_logs': audit_logs}
 
 def format_time(time_str):
-    dt = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+    dt = fromisoformat(time_str)
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
+@functools.lru_cache(maxsize=4096)
+def _deadline_epoch(deadline_str):
+    """Epoch seconds of a build deadline (memoized, builds often share deadlines)"""
+    return fromisoformat(deadline_str).timestamp()
+
 def format_time_remaining(remaining_seconds):
     """Format time remaining in human-readable format like '1d', '1h', '1h2m'"""
     if remaining_seconds <= 0:
         return None
-    
-    days = int(remaining_seconds // 86400)
-    hours = int((remaining_seconds % 86400) // 3600)
-    minutes = int((remaining_seconds % 3600) // 60)
+    # Only whole minutes are shown, so rows sharing a minute share the cached result
+    return _format_minutes_remaining(int(remaining_seconds // 60))
+
+@functools.lru_cache(maxsize=4096)
+def _format_minutes_remaining(total_minutes):
+    days, minutes = divmod(total_minutes, 1440)
+    hours, minutes = divmod(minutes, 60)
     
     if days > 0:
-        if hours > 0:
-            return f"{days}d{hours}h"
-        else:
-            return f"{days}d"
+        return f"{days}d{hours}h" if hours > 0 else f"{days}d"
     elif hours > 0:
-        if minutes > 0:
-            return f"{hours}h{minutes}m"
-        else:
-            return f"{hours}h"
+        return f"{hours}h{minutes}m" if minutes > 0 else f"{hours}h"
     else:
         return f"{minutes}m"
 
 def get_templates(token):
     """Fetch templates from Coder API"""
     url = f"{CODER_URL}/api/v2/templates"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
+    # Templates rarely change, so a copy from the last few minutes is good enough
+    status_code, templates = cached_get(SESSION, url, ttl_seconds=TEMPLATES_CACHE_TTL)
+    if status_code == 200:
         # API returns a list directly, not an object with "templates" key
-        return response.json()
+        return templates
     else:
-        print(f"Error fetching templates: {response.status_code}")
+        print(f"Error fetching templates: {status_code}")
         return []
 
-def get_workspace_details(token, workspace_id):
-    """Get workspace details including template_id, ttl_ms, deadline, and status"""
-    url = f"{CODER_URL}/api/v2/workspaces/{workspace_id}"
-
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        return {
-            'ttl_ms': data.get('ttl_ms', None),
-            'template_id': data.get('template_id', None),
-            'deadline': data.get('latest_build', {}).get('deadline', None),
-            'status': data.get('latest_build', {}).get('status', None)
-        }
-    else:
-        return {'ttl_ms': None, 'template_id': None, 'deadline': None, 'status': None}
+def get_all_workspaces_indexed(token):
+    """Fetch every workspace in one request and index them by workspace id"""
+    url = f"{CODER_URL}/api/v2/workspaces?limit=0"
 
-def extract_workspace_activity(token, logs, template_map):
-    workspace_activities = []
-    workspace_latest = {}  # Track the latest start time for each workspace
+    # Always fetched fresh: ttl_ms, status and deadline must reflect a --set-ttl just made
+    response = SESSION.get(url)
+    if response.status_code != 200:
+        print(f"Error fetching workspaces: {response.status_code}")
+        return {}
 
-    for log in logs.get('audit_logs', []):
-        # pprint.pprint(log)
-        # break  # Only print the first one for brevity
+    data = response_json(response)
+    # Handle both list (older API) and dict with 'workspaces' key (newer API)
+    workspaces = data if isinstance(data, list) else data.get("workspaces", [])
+    return {ws['id']: ws for ws in workspaces}
 
+def extract_workspace_activity(token, logs, template_map):
+    # First pass, no HTTP: keep only the latest start event of each workspace.
+    # Raw RFC 3339 UTC strings sort chronologically, so nothing is parsed here.
+    latest_log_by_id = {}  # workspace_id -> (log_time, log)
+    for log in logs.get('audit_logs', []):
         if (log.get('resource_type') == 'workspace_build' and
             log.get('action') == 'start'):
 
-            username = log.get('user', {}).get('username')
-            workspace_name = log.get('additional_fields', {}).get('workspace_name', 'N/A')
             ## workspace_id = log.get('resource_target', 'N/A')
             workspace_id = log.get('additional_fields', {}).get('workspace_id', 'N/A')
-
-            start_time = format_time(log.get('time', ''))
             log_time = log.get('time', '')
+
+            latest = latest_log_by_id.get(workspace_id)
+            if latest is None or log_time > latest[0]:
+                latest_log_by_id[workspace_id] = (log_time, log)
+
+    # One reference time (epoch seconds) for every workspace's remaining-time calculation
+    now_ts = time.time()
+
+    # Details come from one bulk /workspaces fetch rather than a request per workspace
+    workspaces_index = get_all_workspaces_indexed(token)
+
+    def iter_activities():
+        # Build each workspace's record only as it is consumed, formatting only the winning times
+        for workspace_id, (log_time, log) in latest_log_by_id.items():
+            workspace = workspaces_index.get(workspace_id, {})
+            latest_build = workspace.get('latest_build') or {}
+            template_id = workspace.get('template_id')
+            template_name = template_map.get(template_id, 'Unknown') if template_id else 'N/A'
             
-            # Only keep the latest start event for each workspace
-            if workspace_id not in workspace_latest or log_time > workspace_latest[workspace_id]['log_time']:
-                workspace_details = get_workspace_details(token, workspace_id)
-                ttl_ms = workspace_details['ttl_ms']
-                template_id = workspace_details['template_id']
-                template_name = template_map.get(template_id, 'Unknown') if template_id else 'N/A'
-                
-                # Calculate until_stop time using workspace deadline (only for running workspaces)
-                until_stop = None
+            # Calculate until_stop time using workspace deadline (only for running workspaces)
+            until_stop = None
+            deadline_str = latest_build.get('deadline')
+            # Stopped workspaces (the usual case) never reach the deadline parse
+            if deadline_str and latest_build.get('status') == 'running':
                 try:
-                    # Only show until_stop for currently running workspaces
-                    if workspace_details['status'] == 'running':
-                        deadline_str = workspace_details['deadline']
-                        if deadline_str:
-                            deadline_dt = datetime.fromisoformat(deadline_str.replace('Z', '+00:00'))
-                            now = datetime.now(timezone.utc)
-                            
-                            if deadline_dt > now:
-                                remaining_seconds = (deadline_dt - now).total_seconds()
-                                until_stop = format_time_remaining(remaining_seconds)
+                    remaining_seconds = _deadline_epoch(deadline_str) - now_ts
+                    if remaining_seconds > 0:
+                        until_stop = format_time_remaining(remaining_seconds)
                 except Exception:
                     until_stop = None
 
-                workspace_latest[workspace_id] = {
-                    'username': username,
-                    'workspace_name': workspace_name,
-                    'workspace_id': workspace_id,
-                    'start_time': start_time,
-                    'log_time': log_time,
-                    'ttl_ms': ttl_ms,
-                    'template_name': template_name,
-                    'until_stop': until_stop
-                }
+            yield {
+                'username': log.get('user', {}).get('username'),
+                'workspace_name': log.get('additional_fields', {}).get('workspace_name', 'N/A'),
+                'workspace_id': workspace_id,
+                'start_time': format_time(log_time),
+                'log_time': log_time,
+                'ttl_ms': workspace.get('ttl_ms'),
+                'template_name': template_name,
+                'until_stop': until_stop
+            }
 
-    # Convert dictionary values to list
-    return list(workspace_latest.values())
+    return iter_activities()
 
 def update_workspace_ttl(token, workspace_id, ttl_ms):
     url = f"{CODER_URL}/api/v2/workspaces/{workspace_id}/ttl"
-    # Extend global headers with Content-Type for PUT request
-    put_headers = {**headers, 'Content-Type': 'application/json'}
     payload = {
         "ttl_ms": ttl_ms
     }
 
-    response = requests.put(url, headers=put_headers, data=json.dumps(payload))
+    # json= encodes the payload and sets the Content-Type header
+    response = SESSION.put(url, json=payload)
     if response.status_code in (200, 204):
         print(f"Successfully updated TTL for workspace {workspace_id} to {ttl_ms} ms.")
     else:
@@ -194,6 +210,7 @@ def main():
         print(f"{'Username':<15} {'Workspace Name':<25} {'Template':<20} {'Workspace ID':<40} {'Start Time':<25} {'TTL (ms)':<15} {'Until Stop':<10}")
         print("-" * 180)
 
+        total = 0
         for activity in activities:
             until_stop_str = activity['until_stop'] if activity['until_stop'] else ''
             print(f"{activity['username'] or 'N/A':<15} "
@@ -203,8 +220,9 @@ def main():
                   f"{activity['start_time']:<25} "
                   f"{activity['ttl_ms'] if activity['ttl_ms'] is not None else 'N/A':<15} "
                   f"{until_stop_str:<10}")
+            total += 1
 
-        print(f"\nTotal workspace start events found: {len(activities)}")
+        print(f"\nTotal workspace start events found: {total}")
 
     except json.JSONDecodeError:
         print("Error: Invalid JSON response from API")
@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 import json
 import sys
-import requests
-from datetime import datetime
+import functools
 import os
-from tabulate import tabulate
 
 import argparse
 
+from coder_api import fromisoformat, response_json, build_session
+
 # Add audit-token.txt or manually in this script
 
+# Shared session; the token is sent per request
+SESSION = build_session()
+
 def get_fqdn():
     if os.environ.get("CODER_URL"):
       return os.environ.get("CODER_URL")
@@ -25,17 +28,18 @@ def get_audit_logs(token, coder_url, limit=0):
     }
     params = {'limit': limit}
     
-    response = requests.get(url, headers=headers, params=params)
+    response = SESSION.get(url, headers=headers, params=params)
     if response.status_code != 200:
         print(f"Error fetching audit logs: {response.status_code}")
         sys.exit(1)
     
-    return response.json()
+    return response_json(response)
 
+@functools.lru_cache(maxsize=8192)
 def format_datetime(datetime_str):
-    """Format datetime string to a more readable format"""
+    """Format datetime string to a more readable format (memoized, users' last_seen_at repeats on every log)"""
     try:
-        dt = datetime.fromisoformat(datetime_str.replace('Z', '+00:00'))
+        dt = fromisoformat(datetime_str)
         return dt.strftime('%Y-%m-%d %H:%M:%S')
     except:
         return datetime_str
@@ -93,6 +97,7 @@ def process_audit_logs(logs):
 def main():
     parser = argparse.ArgumentParser(description="Monitor user last seen times from Coder audit logs.")
     parser.add_argument('--deployment', type=str, help='The Coder deployment URL.')
+    parser.add_argument('--tsv', action='store_true', help='Print plain TSV instead of a boxed table (much faster for large audit logs).')
     args = parser.parse_args()
 
     coder_url = args.deployment if args.deployment else get_fqdn()
@@ -111,9 +116,13 @@ def main():
     # Process the logs
     results = process_audit_logs(logs)
     
-    # Display results in a table
+    # Display results in a table (tabulate is only imported once there is one to print)
+    from tabulate import tabulate
     headers = ["Username", "Workspace Name", "Action Time", "Activity Bump", "Last Seen At", "Status"]
-    print(tabulate(results, headers=headers, tablefmt="pretty"))
+    if args.tsv:
+        print(tabulate(results, headers=headers, tablefmt="tsv", disable_numparse=True))
+    else:
+        print(tabulate(results, headers=headers, tablefmt="pretty"))
     
     print(f"\nTotal entries: {len(results)}")
 
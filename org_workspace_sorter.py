@@ -6,12 +6,22 @@ Collects Organizations in the Coder Deployment, lists Workspaces for each,
 and sorts them by last used/stopped time.
 """
 
-import requests
 import json
 import datetime
 import os
 import sys
-from tabulate import tabulate
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+from coder_api import fromisoformat, response_json, build_session as api_session
+from coder_cache import cached_get
+
+# Items per page for paginated endpoints, and how many pages are fetched at once
+PAGE_SIZE = 200
+MAX_PAGE_WORKERS = 5
+
+# Seconds the organizations list may be served from the on-disk cache
+ORGANIZATIONS_CACHE_TTL = 300
 
 # Configuration
 def get_token():
@@ -28,47 +38,63 @@ def get_fqdn():
     # but strictly it should be provided.
     return "http://localhost:3000"
 
-FQDN = get_fqdn()
-CODER_URL = f"{FQDN}"
-TOKEN = get_token()
-
-headers = {
-    'Accept': 'application/json',
-    'Coder-Session-Token': TOKEN
-}
+def build_session():
+    """Build the API session, exiting if no token is configured"""
+    token = get_token()
+    if not token:
+        print("Error: No authentication token found. Please set CODER_TOKEN env var or create audit-token.txt.")
+        sys.exit(1)
+    return api_session(token)
 
-def get_organizations():
+def get_organizations(session, base_url):
     """Fetch all organizations from Coder API"""
-    url = f"{CODER_URL}/api/v2/organizations"
+    url = f"{base_url}/api/v2/organizations"
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            return response.json()
+        # Organizations change rarely; cached on disk and revalidated by ETag
+        status_code, organizations = cached_get(session, url, ttl_seconds=ORGANIZATIONS_CACHE_TTL)
+        if status_code == 200:
+            return organizations
         else:
-            print(f"Error fetching organizations: {response.status_code} - {response.text}")
+            print(f"Error fetching organizations: {status_code}")
             return []
     except Exception as e:
         print(f"Error connecting to organizations API: {e}")
         return []
 
-def get_workspaces():
+def fetch_paginated(session, url, key, page_size=PAGE_SIZE):
+    """
+    Fetch every item of a paginated Coder list endpoint: the first page reports
+    the total count, and the remaining pages are fetched concurrently.
+    Returns None if the first page fails.
+    """
+    def fetch_page(offset):
+        response = session.get(url, params={'limit': page_size, 'offset': offset})
+        if response.status_code != 200:
+            print(f"Error fetching {url} (offset {offset}): {response.status_code} - {response.text}")
+            return None
+        return response_json(response)
+
+    first = fetch_page(0)
+    if first is None:
+        return None
+    # Handle both list (older API, unpaginated) and dict with `key` and 'count' (newer API)
+    if isinstance(first, list):
+        return first
+
+    items = first.get(key, [])
+    offsets = range(page_size, first.get('count', len(items)), page_size)
+    with ThreadPoolExecutor(max_workers=MAX_PAGE_WORKERS) as executor:
+        for page in executor.map(fetch_page, offsets):
+            if page:
+                items.extend(page.get(key, []))
+    return items
+
+def get_workspaces(session, base_url):
     """Fetch all workspaces from Coder API"""
-    # Fetching all workspaces. In a very large deployment, pagination might be needed.
-    # The default limit is often 20 or 25. We set limit=0 (if supported) or a high number.
-    # Coder API usually supports ?limit= and ?offset=. 
-    # For this script, we'll try a reasonably high limit.
-    url = f"{CODER_URL}/api/v2/workspaces?limit=1000" 
+    url = f"{base_url}/api/v2/workspaces"
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            # Handle both list (older API) and dict with 'workspaces' key (newer API)
-            if isinstance(data, list):
-                return data
-            return data.get("workspaces", [])
-        else:
-            print(f"Error fetching workspaces: {response.status_code} - {response.text}")
-            return []
+        workspaces = fetch_paginated(session, url, "workspaces")
+        return workspaces if workspaces is not None else []
     except Exception as e:
         print(f"Error connecting to workspaces API: {e}")
         return []
@@ -78,7 +104,7 @@ def parse_time(time_str):
     if not time_str or time_str == "0001-01-01T00:00:00Z":
         return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
     try:
-        return datetime.datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+        return fromisoformat(time_str)
     except ValueError:
         return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
 
@@ -87,20 +113,27 @@ def format_date(date_str):
     if not date_str or date_str == "0001-01-01T00:00:00Z":
         return "Never"
     try:
-        dt = datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        dt = fromisoformat(date_str)
         return dt.strftime("%Y-%m-%d %H:%M:%S")
-    except:
+    except ValueError:
         return date_str
 
 def main():
-    if not TOKEN:
-        print("Error: No authentication token found. Please set CODER_TOKEN env var or create audit-token.txt.")
-        sys.exit(1)
+    session = build_session()
+    base_url = get_fqdn()
+    # Set CODER_TSV to print plain TSV tables instead (much faster for large organizations)
+    tsv = bool(os.environ.get("CODER_TSV"))
+
+    print(f"Connecting to {base_url}...")
 
-    print(f"Connecting to {CODER_URL}...")
+    # The two listings are independent, so fetch them concurrently
+    # (workspace pages are further fanned out inside fetch_paginated)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        organizations_future = executor.submit(get_organizations, session, base_url)
+        workspaces_future = executor.submit(get_workspaces, session, base_url)
 
     # 1. Collect Organizations
-    organizations = get_organizations()
+    organizations = organizations_future.result()
     if not organizations:
         print("No organizations found or failed to fetch organizations.")
         # Proceeding might be possible if we just list workspaces, but request was specific.
@@ -109,20 +142,22 @@ def main():
     org_map = {org['id']: org['name'] for org in organizations}
     
     # 2. Collect Workspaces
-    workspaces = get_workspaces()
+    workspaces = workspaces_future.result()
     if not workspaces:
         print("No workspaces found.")
         sys.exit(0)
 
-    # 3. Group Workspaces by Organization
-    # structure: { org_id: [workspace1, workspace2, ...] }
+    # Imported only once there is a table to print
+    from tabulate import tabulate
+
+    # 3. Group Workspaces by Organization, parsing each sort key once on the way
+    # structure: { org_id: [(last_used_dt, workspace1), (last_used_dt, workspace2), ...] }
     workspaces_by_org = {}
     
     for ws in workspaces:
         org_id = ws.get('organization_id', 'Unknown')
-        if org_id not in workspaces_by_org:
-            workspaces_by_org[org_id] = []
-        workspaces_by_org[org_id].append(ws)
+        # If it's never used, parse_time puts it last
+        workspaces_by_org.setdefault(org_id, []).append((parse_time(ws.get('last_used_at')), ws))
 
     # 4. Sort and Display
     print("\n" + "="*80)
@@ -148,25 +183,16 @@ def main():
             print("  (No workspaces)")
             continue
 
-        # Sort workspaces
-        # Primary key: last_used_at
-        # Secondary key: created_at (as tie breaker)
+        # Sort workspaces by the pre-parsed last_used_at
         # We want DESCENDING order (newest first)
-        def sort_key(ws):
-            last_used = ws.get('last_used_at')
-            # If last_used is null, check if it's running? 
-            # Or use created_at? 
-            # If it's never used, it should probably be last.
-            return parse_time(last_used)
-
-        org_workspaces.sort(key=sort_key, reverse=True)
+        org_workspaces.sort(key=itemgetter(0), reverse=True)
 
         print(f"\nOrganization: {org_name}")
         
         table_data = []
         headers = ["Workspace", "Owner", "Status", "Last Used", "Created"]
 
-        for ws in org_workspaces:
+        for _, ws in org_workspaces:
             name = ws.get('name', 'N/A')
             owner = ws.get('owner_name', 'N/A')
             status = ws.get('latest_build', {}).get('status', 'N/A')
@@ -178,7 +204,10 @@ def main():
 
             table_data.append([name, owner, status, last_used_fmt, created_fmt])
 
-        print(tabulate(table_data, headers=headers, tablefmt="simple"))
+        if tsv:
+            print(tabulate(table_data, headers=headers, tablefmt="tsv", disable_numparse=True))
+        else:
+            print(tabulate(table_data, headers=headers, tablefmt="simple"))
 
 if __name__ == "__main__":
     main()